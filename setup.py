@@ -15,11 +15,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import codecs
+import functools
 import os
-import re
+import pathlib
 
-from setuptools import find_packages, setup
+from setuptools import setup
 
 
 HERE = os.path.abspath(os.path.dirname(__file__))
@@ -28,41 +28,47 @@ HERE = os.path.abspath(os.path.dirname(__file__))
 #####
 # Helper functions
 #####
-def read(*filenames, **kwargs):
+@functools.lru_cache(maxsize=None)
+def read(filename, encoding='utf-8'):
     """
-    Build an absolute path from ``*filenames``, and  return contents of
+    Build an absolute path from ``filename``, and  return contents of
     resulting file.  Defaults to UTF-8 encoding.
     """
-    encoding = kwargs.get('encoding', 'utf-8')
-    sep = kwargs.get('sep', '\n')
-    buf = []
-    for fl in filenames:
-        with codecs.open(os.path.join(HERE, fl), 'rb', encoding) as f:
-            buf.append(f.read())
-    return sep.join(buf)
+    return pathlib.Path(HERE, filename).read_text(encoding=encoding)
+
+
+def parse_meta(meta_file):
+    """Collect ``__key__ = 'value'`` assignments from *meta_file*."""
+    meta = {}
+    for line in meta_file.splitlines():
+        if not line.startswith('__') or ' = ' not in line:
+            continue
+        key, _, value = line.partition(' = ')
+        value = value.strip()
+        if value[:1] in ('"', "'"):
+            meta[key.strip('_')] = value.strip('\'"')
+    return meta
 
 
 def find_meta(meta):
     """Extract __*meta*__ from META_FILE."""
-    re_str = r"^__{meta}__ = ['\"]([^'\"]*)['\"]".format(meta=meta)
-    meta_match = re.search(re_str, META_FILE, re.M)
-    if meta_match:
-        return meta_match.group(1)
-    raise RuntimeError('Unable to find __{meta}__ string.'.format(meta=meta))
+    try:
+        return _META[meta]
+    except KeyError:
+        raise RuntimeError(
+            'Unable to find __{meta}__ string.'.format(meta=meta))
 
 
 def install_requires():
-    reqs_txt = read('requirements.txt')
-    parsed = reqs_txt.split('\n')
-    parsed = [r.split('==')[0] for r in parsed]
-    return [r for r in parsed if len(r) > 0]
+    return [line.partition('==')[0]
+            for line in read('requirements.txt').splitlines() if line]
 
 
 #####
 # Project-specific constants
 #####
 NAME = 'ulogger'
-PACKAGES = find_packages(exclude=['tests*'])
+PACKAGES = [NAME]
 META_PATH = os.path.join(NAME, '__init__.py')
 KEYWORDS = ['logging']
 CLASSIFIERS = [
@@ -79,6 +85,7 @@ CLASSIFIERS = [
     'Topic :: Software Development :: Libraries :: Python Modules',
 ]
 META_FILE = read(META_PATH)
+_META = parse_meta(META_FILE)
 
 
 setup(
@@ -86,7 +93,7 @@ setup(
     version=find_meta('version'),
     license=find_meta('license'),
     description=find_meta('description'),
-    long_description=open('README.md').read(),
+    long_description=read('README.md'),
     long_description_content_type='text/markdown',
     url=find_meta('uri'),
     author=find_meta('author'),
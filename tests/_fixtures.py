@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import itertools
+
+
+CUSTOM_FMT = '%(created)f %(levelno)d %(message)s'
+DATEFMTS = (
+    # explicit default
+    '%Y-%m-%dT%H:%M:%S',
+    # custom
+    '%d/%m/%y %H:%M:%S.%f',
+    # implicit default
+    None,
+)
+
+
+def fmt_datefmt_matrix(default_fmt):
+    """Every (fmt, datefmt) pair for a handler's default log format.
+
+    Format options are the explicit default, a custom format, and the
+    implicit default (`None`).
+    """
+    fmts = (default_fmt, CUSTOM_FMT, None)
+    return tuple(itertools.product(fmts, DATEFMTS))
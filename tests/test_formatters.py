@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import os
+import sys
+import time
+
+import pytest
+
+from ulogger import formatters
+
+
+DATEFMT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _make_record(msg='hello %s', args=('world',), exc_info=None):
+    return logging.LogRecord(
+        'foo', logging.INFO, __file__, 1, msg, args, exc_info)
+
+
+@pytest.mark.parametrize('label', ['Z foo', ' host {prog}'])
+@pytest.mark.parametrize('datefmt', [DATEFMT, None])
+def test_default_formatter_matches_stdlib(label, datefmt):
+    record = _make_record()
+    stdlib = logging.Formatter(
+        fmt=formatters.default_fmt(label), datefmt=datefmt)
+    formatter = formatters.DefaultFormatter(label, datefmt=datefmt)
+
+    assert formatter._fmt == stdlib._fmt
+    assert formatter.format(record) == stdlib.format(record)
+
+
+def test_default_formatter_pid_changes():
+    formatter = formatters.DefaultFormatter('Z foo', datefmt=DATEFMT)
+    record = _make_record()
+
+    assert ' ({}): '.format(os.getpid()) in formatter.format(record)
+
+    # e.g. after a fork
+    record.process = 12345
+    assert formatter.format(record).endswith(' (12345): hello world')
+
+
+def test_default_formatter_time_cached(mocker):
+    formatter = formatters.DefaultFormatter('Z foo', datefmt=DATEFMT)
+    formatter.converter = time.gmtime
+    strftime = mocker.spy(formatters.time, 'strftime')
+    first, second, later = _make_record(), _make_record(), _make_record()
+    first.created, second.created, later.created = 60.1, 60.9, 61.0
+
+    assert '1970-01-01T00:01:00' == formatter.formatTime(first, DATEFMT)
+    assert '1970-01-01T00:01:00' == formatter.formatTime(second, DATEFMT)
+    assert '1970-01-01T00:01:01' == formatter.formatTime(later, DATEFMT)
+    assert 2 == strftime.call_count
+
+
+def test_default_formatter_time_cached_per_datefmt():
+    formatter = formatters.DefaultFormatter('Z foo', datefmt=DATEFMT)
+    formatter.converter = time.gmtime
+    record = _make_record()
+    record.created = 3600.5
+
+    assert '1970-01-01T01:00:00' == formatter.formatTime(record, DATEFMT)
+    assert '01' == formatter.formatTime(record, '%H')
+    assert '1970-01-01T01:00:00' == formatter.formatTime(record, DATEFMT)
+
+
+def test_default_formatter_exc_info():
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        record = _make_record(exc_info=sys.exc_info())
+    stdlib = logging.Formatter(
+        fmt=formatters.default_fmt('Z foo'), datefmt=DATEFMT)
+    formatter = formatters.DefaultFormatter('Z foo', datefmt=DATEFMT)
+
+    formatted = formatter.format(record)
+    assert formatted == stdlib.format(record)
+    assert 'ValueError: boom' in formatted
@@ -15,37 +15,58 @@
 # limitations under the License.
 
 import logging
+import os
+import subprocess
+import sys
+from unittest import mock
 
 import pytest
 import requests
+from google.cloud.logging_v2 import handlers as gcl_handlers
+from google.cloud.logging_v2.handlers import transports as gcl_transports
 
+from tests import _fixtures
 from ulogger import exceptions
+from ulogger import formatters
 from ulogger import stackdriver
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    stackdriver._METADATA_CACHE.clear()
+    stackdriver._get_gcl_client.cache_clear()
+    yield
+    stackdriver._METADATA_CACHE.clear()
+    stackdriver._get_gcl_client.cache_clear()
+
+
 @pytest.fixture
-def mock_requests_get(mocker):
-    mock = mocker.Mock()
-    project_id_rsp = mocker.Mock()
-    project_id_rsp.text = 'test-project'
-    host_rsp = mocker.Mock()
-    host_rsp.text = 'cpm-guc99-hostname-1a'
-    instance_id_rsp = mocker.Mock()
-    instance_id_rsp.text = '123123'
-    zone_rsp = mocker.Mock()
-    zone_rsp.text = 'projects/192472736367/zones/us-central1-f'
-    # Ordering matters and reflects calls in CloudLoggingHandlerBuilder.__init__
-    mock.side_effect = [
-        project_id_rsp, host_rsp, instance_id_rsp, zone_rsp,
-    ]
-    mocker.patch('ulogger.stackdriver.requests.get', mock)
+def metadata_tree():
+    return {
+        'project': {
+            'projectId': 'test-project',
+            'numericProjectId': 192472736367,
+        },
+        'instance': {
+            'name': 'cpm-guc99-hostname-1a',
+            'id': 123123,
+            'zone': 'projects/192472736367/zones/us-central1-f',
+        },
+    }
+
+
+@pytest.fixture
+def mock_requests_get(mocker, metadata_tree):
+    rsp = mocker.Mock()
+    rsp.json.return_value = metadata_tree
+    mock = mocker.Mock(return_value=rsp)
+    mocker.patch('ulogger.stackdriver._SESSION.get', mock)
     return mock
 
 
 @pytest.fixture
 def mock_cloud_handler(mocker):
-    mock = mocker.Mock(
-        stackdriver.CloudLoggingHandlerBuilder, autospec=True)
+    mock = mocker.Mock()
     mocker.patch('ulogger.stackdriver.CloudLoggingHandlerBuilder', mock)
     return mock
 
@@ -53,40 +74,59 @@ def mock_cloud_handler(mocker):
 @pytest.fixture
 def mock_logging_resource(mocker):
     mock_resource = mocker.Mock()
-    mocker.patch('ulogger.stackdriver.gcl_resource.Resource', mock_resource)
+    mocker.patch('google.cloud.logging_v2.resource.Resource', mock_resource)
     return mock_resource
 
 
 @pytest.fixture
-def mock_get_logger(mocker):
+def mock_bthread_logger(mocker):
     mock_logger = mocker.Mock()
-    mock_get_logger = mocker.Mock(return_value=mock_logger)
-    mocker.patch('ulogger.stackdriver.logging.getLogger', mock_get_logger)
-    return mock_get_logger, mock_logger
+    mocker.patch('ulogger.stackdriver._BTHREAD_LOGGER', mock_logger)
+    return mock_logger
 
 
 @pytest.fixture
-def mock_gcl_client(mocker, mock_get_logger):
-    _, mock_logger = mock_get_logger
+def mock_gcl_client(mocker, mock_bthread_logger):
     mock_client = mocker.MagicMock()
     mock_client_class = mocker.Mock(return_value=mock_client)
-    mocker.patch(
-        'ulogger.stackdriver.gcl_logging.Client',
-        mock_client_class)
+    mocker.patch('google.cloud.logging_v2.Client', mock_client_class)
     return mock_client, mock_client_class
 
 
+@pytest.fixture(scope='session')
+def cloud_logging_handler_spec():
+    return mock.create_autospec(gcl_handlers.CloudLoggingHandler)
+
+
 @pytest.fixture
-def mock_gcl_handler(mocker):
+def mock_gcl_handler(mocker, cloud_logging_handler_spec):
     mock_handler = mocker.Mock()
-    mock_cloud_handler = mocker.Mock(
-        stackdriver.gcl_handlers.CloudLoggingHandler,
-        autospec=True, return_value=mock_handler)
-    mocker.patch('ulogger.stackdriver.gcl_handlers.CloudLoggingHandler',
+    mock_cloud_handler = cloud_logging_handler_spec
+    mock_cloud_handler.reset_mock()
+    mock_cloud_handler.return_value = mock_handler
+    mocker.patch('google.cloud.logging_v2.handlers.CloudLoggingHandler',
                  mock_cloud_handler)
     return mock_handler, mock_cloud_handler
 
 
+def test_get_handler_without_google_cloud(mock_requests_get, monkeypatch):
+    for name in list(sys.modules):
+        if name.startswith('google.cloud.logging_v2'):
+            monkeypatch.setitem(sys.modules, name, None)
+
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    with pytest.raises(exceptions.ULoggerError) as e:
+        builder.get_handler()
+
+    assert 'pip install "ulogger[stackdriver]"' in str(e.value)
+
+
+def test_import_does_not_load_google_cloud():
+    code = ('import sys; import ulogger.stackdriver; '
+            'assert "google.cloud.logging_v2" not in sys.modules')
+    subprocess.check_call([sys.executable, '-c', code])
+
+
 def test_get_handler(mocker):
     builder = mocker.Mock()
     mocker.patch('ulogger.stackdriver.CloudLoggingHandlerBuilder', builder)
@@ -96,13 +136,17 @@ def test_get_handler(mocker):
 
     builder.assert_called_once_with(
             'test-progname', project_id='example-project', credentials=None,
-            fmt=None, datefmt=None, debug_thread_worker=False)
+            hostname=None, instance_id=None, zone=None,
+            fmt=None, datefmt=None, debug_thread_worker=False,
+            batch_size=None, max_latency=None)
 
 
 def test_builder_create_gcl_resource(mocker, mock_requests_get,
                                      mock_logging_resource):
-    stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    mock_logging_resource.assert_not_called()
 
+    assert builder.resource is builder.resource
     expected_args = ['gce_instance', {
         'project_id': 'test-project',
         'instance_id': '123123',
@@ -115,12 +159,20 @@ builder_kwargs = [
     {'project_id': None, 'credentials': None},
     {'project_id': 'example-project', 'credentials': 'example-credentials'}
 ]
+format_args = [
+    (None, None),
+    ('%(created)f %(message)s', None),
+    (None, '%Y-%m-%dT%H:%M:%S'),
+]
 
 
-@pytest.mark.parametrize('project_id,credentials', builder_kwargs)
+@pytest.mark.parametrize('fmt,datefmt', format_args)
+@pytest.mark.parametrize('project_id,credentials', [
+    (kw['project_id'], kw['credentials']) for kw in builder_kwargs])
 def test_builder_get_handler(mocker, mock_requests_get, mock_logging_resource,
-                             project_id, credentials, mock_get_logger,
-                             mock_gcl_client, mock_gcl_handler):
+                             project_id, credentials, fmt, datefmt,
+                             mock_bthread_logger, mock_gcl_client,
+                             mock_gcl_handler):
 
     mock_client, mock_client_class = mock_gcl_client
     mock_handler, mock_cloud_handler = mock_gcl_handler
@@ -128,110 +180,361 @@ def test_builder_get_handler(mocker, mock_requests_get, mock_logging_resource,
     mocker.patch('ulogger.stackdriver.CloudLoggingHandlerBuilder.get_formatter',
                  mocker.Mock(return_value=mock_formatter))
 
-    get_logger, logger = mock_get_logger
-    get_logger.reset_mock()
-
     factory = stackdriver.CloudLoggingHandlerBuilder(
-            'test-program', project_id=project_id, credentials=credentials)
+            'test-program', project_id=project_id, credentials=credentials,
+            fmt=fmt, datefmt=datefmt)
     factory.get_handler()
 
     expected_labels = {
         'resource_id': factory.instance_id,
         'resource_project': factory.project_id,
         'resource_zone': factory.zone,
-        'resource_host': factory.hostname}
+        'resource_host': factory.hostname,
+        'progname': 'test-program',
+        'pid': str(os.getpid())}
     mock_cloud_handler.assert_called_once_with(
         mock_client,
+        transport=gcl_transports.BackgroundThreadTransport,
         resource=factory.resource,
         labels=expected_labels)
     expected_project_id = project_id if project_id else factory.project_id
     mock_client_class.assert_called_once_with(
         project=expected_project_id, credentials=credentials)
-    mock_handler.setFormatter.assert_called_once_with(mock_formatter)
-    get_logger.assert_called_once_with(
-        'google.cloud.logging_v2.handlers.transports.background_thread')
-    logger.setLevel.assert_called_once_with(logging.INFO)
+    if fmt or datefmt:
+        mock_handler.setFormatter.assert_called_once_with(mock_formatter)
+    else:
+        mock_handler.setFormatter.assert_not_called()
+    mock_bthread_logger.setLevel.assert_called_once_with(logging.INFO)
+
+
+def test_builder_get_handler_shares_client(mocker, mock_requests_get,
+                                           mock_logging_resource,
+                                           mock_gcl_client, mock_gcl_handler):
+    mock_client, mock_client_class = mock_gcl_client
+    _, mock_cloud_handler = mock_gcl_handler
+    credentials = mocker.Mock()
+
+    for progname in ('foo', 'bar'):
+        stackdriver.CloudLoggingHandlerBuilder(
+            progname, credentials=credentials).get_handler()
+    stackdriver.CloudLoggingHandlerBuilder(
+        'foo', project_id='other-project',
+        credentials=credentials).get_handler()
+
+    assert 2 == mock_client_class.call_count
+    mock_client_class.assert_has_calls([
+        mocker.call(project='test-project', credentials=credentials),
+        mocker.call(project='other-project', credentials=credentials),
+    ])
+    clients = [c[0][0] for c in mock_cloud_handler.call_args_list]
+    assert [mock_client] * 3 == clients
+
+
+@pytest.mark.parametrize('batch_size,max_latency,exp_kwargs', [
+    (1000, None, {'batch_size': 1000}),
+    (None, 0.5, {'max_latency': 0.5}),
+    (1000, 0.5, {'batch_size': 1000, 'max_latency': 0.5}),
+])
+def test_builder_get_handler_batching(batch_size, max_latency, exp_kwargs,
+                                      mock_requests_get, mock_logging_resource,
+                                      mock_gcl_client, mock_gcl_handler):
+    _, mock_cloud_handler = mock_gcl_handler
+
+    stackdriver.CloudLoggingHandlerBuilder(
+        'test-program', batch_size=batch_size,
+        max_latency=max_latency).get_handler()
+
+    transport = mock_cloud_handler.call_args[1]['transport']
+    assert gcl_transports.BackgroundThreadTransport is transport.func
+    assert exp_kwargs == transport.keywords
+
+
+def test_builder_get_handler_after_get_formatter(mock_requests_get,
+                                                 mock_logging_resource,
+                                                 mock_gcl_client,
+                                                 mock_gcl_handler):
+    mock_handler, _ = mock_gcl_handler
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+
+    builder.get_formatter()
+    builder.get_handler()
+
+    mock_handler.setFormatter.assert_not_called()
+
+
+def test_builder_get_metadata_lazily(mock_requests_get):
+    builder = stackdriver.CloudLoggingHandlerBuilder(
+        'test-progname', project_id='example-project')
+
+    assert 'example-project' == builder.project_id
+    mock_requests_get.assert_not_called()
+
+    assert 'cpm-guc99-hostname-1a' == builder.hostname
+    assert 'example-project' == builder.project_id
+    mock_requests_get.assert_called_once()
+
+
+def test_builder_explicit_metadata(mock_requests_get, mock_logging_resource,
+                                   mock_gcl_client, mock_gcl_handler):
+    builder = stackdriver.CloudLoggingHandlerBuilder(
+        'test-progname', project_id='example-project', hostname='my-host',
+        instance_id='42', zone='europe-west1-d')
+
+    builder.get_handler()
+    builder.get_formatter()
+
+    assert 'my-host' == builder.hostname
+    assert '42' == builder.instance_id
+    assert 'europe-west1-d' == builder.zone
+    mock_logging_resource.assert_called_once_with('gce_instance', {
+        'project_id': 'example-project',
+        'instance_id': '42',
+        'zone': 'europe-west1-d'})
+    mock_requests_get.assert_not_called()
+
+
+def test_builder_partial_explicit_metadata(mock_requests_get):
+    builder = stackdriver.CloudLoggingHandlerBuilder(
+        'test-progname', hostname='my-host')
+
+    assert 'my-host' == builder.hostname
+    mock_requests_get.assert_not_called()
+
+    assert '123123' == builder.instance_id
+    assert 'us-central1-f' == builder.zone
+    mock_requests_get.assert_called_once()
 
 
 def test_builder_get_metadata(mock_requests_get):
-    gapi_endpoint = ('http://metadata.google.internal/computeMetadata'
-                     '/v1/{0}/{1}')
-    stackdriver.CloudLoggingHandlerBuilder('test-progname')
-
-    expected_gapi_headers = {'Metadata-Flavor': 'Google'}
-    expected_url_params = [
-        ('instance', 'id'),
-        ('instance', 'zone'),
-        ('project', 'project-id'),
-    ]
-    for data_type, key in expected_url_params:
-        mock_requests_get.assert_any_call(
-            gapi_endpoint.format(data_type, key),
-            headers=expected_gapi_headers,
-            timeout=5)
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    builder.project_id
+
+    mock_requests_get.assert_called_once_with(
+        'http://metadata.google.internal/computeMetadata/v1/'
+        '?recursive=true&alt=json',
+        headers={'Metadata-Flavor': 'Google'},
+        timeout=1)
+    assert 'test-project' == builder.project_id
+    assert 'cpm-guc99-hostname-1a' == builder.hostname
+    assert '123123' == builder.instance_id
+    assert 'us-central1-f' == builder.zone
+
+
+def test_builder_get_metadata_cached(mock_requests_get):
+    first = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    second = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+
+    assert first.project_id == second.project_id == 'test-project'
+    assert first.hostname == second.hostname == 'cpm-guc99-hostname-1a'
+    assert first.instance_id == second.instance_id == '123123'
+    assert first.zone == second.zone == 'us-central1-f'
+    assert 1 == mock_requests_get.call_count
 
 
 def test_builder_get_metadata_network_error(mock_requests_get):
     mock_requests_get.side_effect = requests.exceptions.RequestException(
         'Network error!')
 
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
     with pytest.raises(exceptions.GoogleCloudError):
-        stackdriver.CloudLoggingHandlerBuilder('test-progname')
+        builder.resource
 
 
-def test_builder_get_metadata_raises_on_empty_rsp(mocker, mock_requests_get):
-    mock_rsp = mocker.Mock()
-    mock_rsp.text = ''
-    mock_requests_get.side_effect = [mock_rsp]
+HOST_ENV = {
+    'GOOGLE_CLOUD_PROJECT': 'env-project',
+    'HOSTNAME': 'env-hostname',
+    'GCE_INSTANCE_ID': '456456',
+    'GCE_ZONE': 'europe-west1-b',
+}
+
+
+def test_builder_get_metadata_env_fallback(mock_requests_get, monkeypatch):
+    mock_requests_get.side_effect = requests.exceptions.RequestException(
+        'Network error!')
+    for name, value in HOST_ENV.items():
+        monkeypatch.setenv(name, value)
+
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+
+    assert 'env-project' == builder.project_id
+    assert 'env-hostname' == builder.hostname
+    assert '456456' == builder.instance_id
+    assert 'europe-west1-b' == builder.zone
+    assert 1 == mock_requests_get.call_count
+
+
+@pytest.mark.parametrize('given,env_var', [
+    ('project_id', 'GOOGLE_CLOUD_PROJECT'),
+    ('hostname', 'HOSTNAME'),
+    ('instance_id', 'GCE_INSTANCE_ID'),
+    ('zone', 'GCE_ZONE'),
+])
+def test_builder_get_metadata_env_fallback_partial(mock_requests_get,
+                                                   monkeypatch, given,
+                                                   env_var):
+    mock_requests_get.side_effect = requests.exceptions.RequestException(
+        'Network error!')
+    monkeypatch.delenv('GCP_PROJECT', raising=False)
+    for name, value in HOST_ENV.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv(env_var)
 
+    builder = stackdriver.CloudLoggingHandlerBuilder(
+        'test-progname', **{given: 'given-value'})
+
+    assert 'given-value' == getattr(builder, given)
+    assert {
+        'project_id': 'env-project',
+        'hostname': 'env-hostname',
+        'instance_id': '456456',
+        'zone': 'europe-west1-b',
+        given: 'given-value',
+    } == {
+        'project_id': builder.project_id,
+        'hostname': builder.hostname,
+        'instance_id': builder.instance_id,
+        'zone': builder.zone,
+    }
+
+
+def test_builder_get_metadata_env_fallback_only_hostname(mock_requests_get,
+                                                         monkeypatch):
+    mock_requests_get.side_effect = requests.exceptions.RequestException(
+        'Network error!')
+    for name in list(HOST_ENV) + ['GCP_PROJECT']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('HOSTNAME', 'env-hostname')
+
+    builder = stackdriver.CloudLoggingHandlerBuilder(
+        'test-progname', project_id='example-project', instance_id='42',
+        zone='europe-west1-d')
+
+    assert 'env-hostname' == builder.hostname
+
+
+def test_builder_get_metadata_env_fallback_not_cached(mock_requests_get,
+                                                      monkeypatch):
+    rsp = mock_requests_get.return_value
+    mock_requests_get.side_effect = [
+        requests.exceptions.RequestException('Network error!'), rsp]
+    for name, value in HOST_ENV.items():
+        monkeypatch.setenv(name, value)
+
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    assert 'env-hostname' == builder.hostname
+    assert not stackdriver._METADATA_CACHE
+
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    assert 'cpm-guc99-hostname-1a' == builder.hostname
+    assert 'test-project' == builder.project_id
+    assert '123123' == builder.instance_id
+    assert 'us-central1-f' == builder.zone
+    assert 2 == mock_requests_get.call_count
+
+
+@pytest.mark.parametrize('missing', sorted(HOST_ENV))
+def test_builder_get_metadata_env_fallback_incomplete(mock_requests_get,
+                                                      monkeypatch, missing):
+    mock_requests_get.side_effect = requests.exceptions.RequestException(
+        'Network error!')
+    monkeypatch.delenv('GCP_PROJECT', raising=False)
+    for name, value in HOST_ENV.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv(missing)
+
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
     with pytest.raises(exceptions.GoogleCloudError):
-        stackdriver.CloudLoggingHandlerBuilder('test-progname')
+        builder.resource
 
 
-fmts = [
-    # explicit default
-    ('%(asctime)s.%(msecs)03d cpm-guc99-hostname-1a test-progname '
-     '(%(process)d): %(message)s'),
-    # custom
-    '%(created)f %(levelno)d %(message)s',
-    # implicit default
-    None
-]
-datefmts = [
-    # explicit default
-    '%Y-%m-%dT%H:%M:%S',
-    # custom
-    '%d/%m/%y %H:%M:%S.%f',
-    # implicit default
-    None
-]
-args = [(f, d) for f in fmts for d in datefmts]
+def test_builder_get_metadata_invalid_json(mock_requests_get):
+    mock_requests_get.return_value.json.side_effect = ValueError('Not JSON')
+
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    with pytest.raises(exceptions.GoogleCloudError):
+        builder.resource
+
+
+@pytest.mark.parametrize('data_type,key', [
+    ('project', 'projectId'), ('instance', 'name'), ('instance', 'zone')])
+@pytest.mark.parametrize('empty', [False, True])
+def test_builder_get_metadata_raises_on_empty_rsp(mock_requests_get,
+                                                  metadata_tree, data_type,
+                                                  key, empty):
+    if empty:
+        metadata_tree[data_type][key] = ''
+    else:
+        del metadata_tree[data_type][key]
+
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    with pytest.raises(exceptions.GoogleCloudError):
+        builder.resource
+
+
+def test_builder_get_single_metadata(mocker, mock_requests_get):
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    rsp = mocker.Mock()
+    rsp.text = 'cpm-guc99-hostname-1a.example.com'
+    mock_requests_get.reset_mock()
+    mock_requests_get.return_value = rsp
+
+    for _ in range(2):
+        hostname = builder._get_metadata('instance', 'hostname')
+        assert 'cpm-guc99-hostname-1a.example.com' == hostname
+
+    mock_requests_get.assert_called_once_with(
+        'http://metadata.google.internal/computeMetadata/v1/'
+        'instance/hostname',
+        headers={'Metadata-Flavor': 'Google'},
+        timeout=1)
+
+
+def test_builder_get_single_metadata_raises_on_empty_rsp(mocker,
+                                                         mock_requests_get):
+    builder = stackdriver.CloudLoggingHandlerBuilder('test-progname')
+    rsp = mocker.Mock()
+    rsp.text = ''
+    mock_requests_get.return_value = rsp
+
+    with pytest.raises(exceptions.GoogleCloudError):
+        builder._get_metadata('instance', 'hostname')
+
+
+DEFAULT_FMT = ('%(asctime)s.%(msecs)03d cpm-guc99-hostname-1a test-progname '
+               '(%(process)d): %(message)s')
+FMT_DATEFMT_MATRIX = _fixtures.fmt_datefmt_matrix(DEFAULT_FMT)
 params = 'fmt,datefmt'
 
 
-@pytest.mark.parametrize(params, args)
+@pytest.mark.parametrize(params, FMT_DATEFMT_MATRIX)
 def test_builder_get_formatter(mocker, mock_requests_get, fmt, datefmt):
     builder = stackdriver.CloudLoggingHandlerBuilder(
         'test-progname', fmt, datefmt)
     formatter = builder.get_formatter()
+    given_fmt = fmt
+    assert formatter is builder.get_formatter()
 
     if not fmt:
-        fmt = fmts[0]
+        fmt = DEFAULT_FMT
     if not datefmt:
-        datefmt = datefmts[0]
+        datefmt = _fixtures.DATEFMTS[0]
 
     assert formatter._fmt == fmt
     assert formatter.datefmt == datefmt
+    is_default = isinstance(formatter, formatters.DefaultFormatter)
+    assert is_default == (given_fmt is None)
+    assert mock_requests_get.called == (given_fmt is None)
 
 
-def test_set_worker_thread_level_to_debug(mock_requests_get, mock_get_logger,
+def test_set_worker_thread_level_to_debug(mock_requests_get,
+                                          mock_bthread_logger,
                                           mock_gcl_handler, mock_gcl_client):
-    get_logger, logger = mock_get_logger
-    get_logger.reset_mock()
-
     stackdriver.CloudLoggingHandlerBuilder(
         'test-progname', debug_thread_worker=True).get_handler()
 
-    get_logger.assert_called_once_with(
-        'google.cloud.logging_v2.handlers.transports.background_thread')
-    logger.setLevel.assert_called_once_with(logging.DEBUG)
+    mock_bthread_logger.setLevel.assert_called_once_with(logging.DEBUG)
+
+
+def test_bthread_logger():
+    bthread_module = gcl_transports.background_thread.__name__
+    assert bthread_module == stackdriver._BTHREAD_LOGGER.name
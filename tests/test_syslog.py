@@ -17,10 +17,16 @@
 
 import logging
 import logging.handlers
+import os
 import socket
+import sys
+import time
 
 import pytest
 
+from tests import _fixtures
+from ulogger import exceptions
+from ulogger import formatters
 from ulogger import syslog
 
 
@@ -46,21 +52,20 @@ def test_get_handler(mocker, monkeypatch):
 
 @pytest.fixture
 def syslog_mock(mocker, monkeypatch):
-    syslog_mock = mocker.MagicMock(
-        logging.handlers.SysLogHandler, autospec=True)
+    syslog_mock = mocker.MagicMock()
     monkeypatch.setattr(syslog.logging.handlers, 'SysLogHandler', syslog_mock)
+    return syslog_mock
 
 
 params = [
     # linux env
-    ['default', ((syslog.sys, 'platform', 'linux2'),),
+    ['default', ((syslog, '_DEFAULT_ENV', 'default'),),
      '/dev/log', SYSLOG_DEFAULT_FMT, EXP_DATE_FORMAT],
     # remote/docker/helios env
     ['remote', ((syslog.os, 'environ', REMOTE_ENV),),
      ('localhost', 12345), SYSLOG_DEFAULT_FMT, EXP_DATE_FORMAT],
     # os x env
-    ['darwin', ((syslog.sys, 'platform', 'darwin'),
-                (syslog.os.path, 'exists', lambda x: True)),
+    ['darwin', ((syslog, '_DEFAULT_ENV', 'darwin'),),
      ('/var/run/syslog'), SYSLOG_OSX_FMT, None]
 ]
 args = 'environ,patches,address,fmt,datefmt'
@@ -81,46 +86,55 @@ def test_syslog_handler_builder_env(environ, patches, address, fmt, datefmt,
     assert formatter._fmt == fmt
     assert formatter.datefmt == datefmt
 
-    formatter_mock = mocker.MagicMock(logging.Formatter, autospec=True)
-    monkeypatch.setattr(syslog.logging, 'Formatter', formatter_mock)
-
     handler = builder.get_handler()
-    handler.setFormatter.assert_called_once_with(formatter_mock.return_value)
+    handler.setFormatter.assert_called_once_with(formatter)
 
 
-fmts = [
-    # explicit default
-    '%(asctime)s.%(msecs)03dZ foo (%(process)d): %(message)s',
-    # custom
-    '%(created)f %(levelno)d %(message)s',
-    # implicit default
-    None
-]
-datefmts = [
-    # explicit default
-    '%Y-%m-%dT%H:%M:%S',
-    # custom
-    '%d/%m/%y %H:%M:%S.%f',
-    # implicit default
-    None
-]
-args = [(f, d) for f in fmts for d in datefmts]
+FMT_DATEFMT_MATRIX = _fixtures.fmt_datefmt_matrix(SYSLOG_DEFAULT_FMT)
 params = 'fmt,datefmt'
 
 
-@pytest.mark.parametrize(params, args)
+@pytest.mark.parametrize('platform,exists,exp', [
+    ('linux', True, 'default'),
+    ('darwin', False, 'default'),
+    ('darwin', True, 'darwin'),
+])
+def test_syslog_default_env(platform, exists, exp, mocker, monkeypatch):
+    monkeypatch.setattr(sys, 'platform', platform)
+    monkeypatch.setattr(os.path, 'exists', mocker.Mock(return_value=exists))
+
+    assert exp == syslog._detect_default_env()
+
+
+def test_syslog_handler_builder_formatter_not_shared(monkeypatch):
+    monkeypatch.setattr(syslog, '_DEFAULT_ENV', 'default')
+    builder = syslog.SyslogHandlerBuilder('foo')
+    formatter = builder.get_formatter()
+    formatter.converter = time.gmtime
+
+    assert formatter is builder.get_formatter()
+    other = syslog.SyslogHandlerBuilder('foo').get_formatter()
+    assert other is not formatter
+    assert other.converter is not time.gmtime
+
+
+@pytest.mark.parametrize(params, FMT_DATEFMT_MATRIX)
 def test_syslog_handler_builder_fmts(fmt, datefmt, monkeypatch):
-    monkeypatch.setattr(syslog.sys, 'platform', 'linux2')
+    monkeypatch.setattr(syslog, '_DEFAULT_ENV', 'default')
     builder = syslog.SyslogHandlerBuilder('foo', fmt=fmt, datefmt=datefmt)
 
     if not fmt:
-        fmt = fmts[0]
+        fmt = SYSLOG_DEFAULT_FMT
     if not datefmt:
-        datefmt = datefmts[0]
+        datefmt = EXP_DATE_FORMAT
+    assert builder.fmt == fmt
+    assert builder.datefmt == datefmt
 
     formatter = builder.get_formatter()
     assert formatter._fmt == fmt
     assert formatter.datefmt == datefmt
+    is_default = isinstance(formatter, formatters.DefaultFormatter)
+    assert is_default == (fmt == SYSLOG_DEFAULT_FMT)
 
 
 args = [
@@ -135,7 +149,7 @@ params = 'given,exp'
 
 @pytest.mark.parametrize(params, args)
 def test_syslog_handler_builder_facility(given, exp, mocker, monkeypatch):
-    monkeypatch.setattr(syslog.sys, 'platform', 'linux2')
+    monkeypatch.setattr(syslog, '_DEFAULT_ENV', 'default')
 
     mock_socket = mocker.Mock()
     mocker.patch.object(socket, 'socket', mock_socket)
@@ -155,6 +169,8 @@ args = [
     ((('localhost', '514'), None), (('localhost', 514), 2)),
     ((('10.99.0.1', None), 1), (('10.99.0.1', 514), 1)),
     (('/dev/log', None), ('/dev/log', 2)),
+    ((b'/dev/log', None), ('/dev/log', 2)),
+    (('/l', None), ('/l', 2)),
 ]
 
 params = 'given,exp'
@@ -162,7 +178,7 @@ params = 'given,exp'
 
 @pytest.mark.parametrize(params, args)
 def test_syslog_handler_builder_address(given, exp, mocker, monkeypatch):
-    monkeypatch.setattr(syslog.sys, 'platform', 'linux2')
+    monkeypatch.setattr(syslog, '_DEFAULT_ENV', 'default')
 
     mock_socket = mocker.Mock()
     mocker.patch.object(socket, 'socket', mock_socket)
@@ -178,6 +194,27 @@ def test_syslog_handler_builder_address(given, exp, mocker, monkeypatch):
     assert handler.socktype == exp[1]
 
 
+@pytest.mark.parametrize('proto,exp', [
+    (None, socket.SOCK_DGRAM),
+    (1, socket.SOCK_STREAM),
+    (2, socket.SOCK_DGRAM),
+    (socket.SOCK_STREAM, socket.SOCK_STREAM),
+    (socket.SOCK_DGRAM, socket.SOCK_DGRAM),
+])
+def test_syslog_handler_builder_proto(proto, exp):
+    builder = syslog.SyslogHandlerBuilder('foo', proto=proto)
+
+    assert exp == builder.proto
+
+
+@pytest.mark.parametrize('proto', [3, 'udp'])
+def test_syslog_handler_builder_proto_unsupported(proto):
+    with pytest.raises(exceptions.ULoggerError) as e:
+        syslog.SyslogHandlerBuilder('foo', proto=proto)
+
+    assert 'Unsupported syslog protocol: "{}"'.format(proto) in str(e.value)
+
+
 args = [
     (
         (('localhost', 514), 2),  # explicit address/proto set
@@ -209,7 +246,7 @@ params = 'given,envs,exp'
 @pytest.mark.parametrize(params, args)
 def test_syslog_handler_builder_address_envs(given, envs, exp,
                                              monkeypatch, mocker):
-    monkeypatch.setattr(syslog.sys, 'platform', 'linux2')
+    monkeypatch.setattr(syslog, '_DEFAULT_ENV', 'default')
 
     patch = {}
     if envs[0]:
@@ -15,26 +15,35 @@
 # limitations under the License.
 
 
+import io
 import logging
 import sys
 from types import ModuleType
 
 import pytest
 
+from tests import _fixtures
 from ulogger import exceptions
 from ulogger import ulogger
 
 
+@pytest.fixture(autouse=True)
+def clear_handler_registry():
+    ulogger._HANDLER_REGISTRY.clear()
+    yield
+    ulogger._HANDLER_REGISTRY.clear()
+
+
 @pytest.fixture
 def logging_mock(mocker, monkeypatch):
-    logging_module = mocker.MagicMock(logging, autospec=True)
+    logging_module = mocker.MagicMock()
     monkeypatch.setattr(ulogger, 'logging', logging_module)
     return logging_module
 
 
 @pytest.fixture
 def import_module_mock(mocker, monkeypatch):
-    import_module = mocker.MagicMock('importlib.import_module', autospec=True)
+    import_module = mocker.MagicMock()
     module_mock = mocker.MagicMock()
     handler = mocker.MagicMock()
     module_mock.get_handler = mocker.MagicMock()
@@ -46,7 +55,7 @@ def import_module_mock(mocker, monkeypatch):
 
 @pytest.fixture
 def setup_default_handler_mock(mocker, monkeypatch):
-    default = mocker.MagicMock(logging.StreamHandler, autospec=True)
+    default = mocker.MagicMock()
     monkeypatch.setattr(ulogger, '_setup_default_handler', default)
     return default
 
@@ -72,15 +81,26 @@ def test_setup_logging(handler, level, logging_mock, import_module_mock,
         handler_mock = import_module_mock.return_value.get_handler.return_value
 
     logging_mock.getLevelName.assert_called_once_with(level)
-    logging_mock.getLogger.assert_called_with('')
-    assert logging_mock.getLogger.call_count == 2
+    logging_mock.getLogger.assert_called_once_with('')
 
     get_logger = logging_mock.getLogger.return_value
-    get_logger.addHandler.assert_called_once_with(handler_mock)
+    get_logger.handlers.append.assert_called_once_with(handler_mock)
     get_logger.setLevel.assert_called_once_with(
         logging_mock.getLevelName(level))
 
 
+def test_setup_logging_caches_handler_function(logging_mock,
+                                               import_module_mock):
+    ulogger.setup_logging('foo', 'INFO', ['syslog'])
+    ulogger.setup_logging('foo', 'INFO', ['syslog'])
+
+    import_module_mock.assert_called_once_with(
+        'ulogger.syslog', package='ulogger')
+    get_handler = import_module_mock.return_value.get_handler
+    assert get_handler is ulogger._HANDLER_REGISTRY['syslog']
+    assert 2 == get_handler.call_count
+
+
 def test_setup_logging_multiple_handlers(import_module_mock,
                                          setup_default_handler_mock):
     handlers = ['stream', 'syslog']
@@ -90,6 +110,19 @@ def test_setup_logging_multiple_handlers(import_module_mock,
     assert len(actual_handlers) == len(handlers)
 
 
+def test_setup_logging_skips_attached_handlers(logging_mock,
+                                               import_module_mock):
+    root = logging_mock.getLogger.return_value
+    handler = import_module_mock.return_value.get_handler.return_value
+    root.handlers = [handler]
+
+    ulogger.setup_logging('foo', 'INFO', ['syslog'])
+
+    assert [handler] == root.handlers
+    root.setLevel.assert_called_once_with(
+        logging_mock.getLevelName.return_value)
+
+
 def test_setup_logging_raises():
     with pytest.raises(exceptions.ULoggerError) as e:
         ulogger.setup_logging('tests', 'INFO', ['notahandler'])
@@ -110,42 +143,57 @@ def test_setup_logging_raises_not_implemented():
         '"get_handler" function not implemented for "{}"'.format(module_name))
 
 
-fmts = [
-    # explicit default
-    '%(asctime)s.%(msecs)03dZ foo (%(process)d) %(levelname)s: %(message)s',
-    # custom
-    '%(created)f %(levelno)d %(message)s',
-    # implicit default
-    None
-]
-datefmts = [
-    # explicit default
-    '%Y-%m-%dT%H:%M:%S',
-    # custom
-    '%d/%m/%y %H:%M:%S.%f',
-    # implicit default
-    None
-]
-args = [(f, d) for f in fmts for d in datefmts]
+DEFAULT_FMT = ('%(asctime)s.%(msecs)03dZ foo (%(process)d) %(levelname)s: '
+               '%(message)s')
+FMT_DATEFMT_MATRIX = _fixtures.fmt_datefmt_matrix(DEFAULT_FMT)
 params = 'fmt,datefmt'
 
 
-@pytest.mark.parametrize(params, args)
+@pytest.mark.parametrize(params, FMT_DATEFMT_MATRIX)
 def test_setup_default_handler(mocker, monkeypatch, fmt, datefmt):
-    handler_mock = mocker.MagicMock(logging.StreamHandler, autospec=True)
+    handler_mock = mocker.MagicMock()
     monkeypatch.setattr(ulogger.logging, 'StreamHandler', handler_mock)
-    logging_mock = mocker.MagicMock(logging, autospec=True)
+    logging_mock = mocker.MagicMock()
     monkeypatch.setattr(ulogger, 'logging', logging_mock)
 
     ret_handler = ulogger._setup_default_handler('foo', fmt, datefmt)
 
     if not fmt:
-        fmt = fmts[0]
+        fmt = DEFAULT_FMT
     if not datefmt:
-        datefmt = datefmts[0]
+        datefmt = _fixtures.DATEFMTS[0]
 
     logging_mock.Formatter.assert_called_once_with(
         fmt=fmt, datefmt=datefmt)
 
     ret_handler.setFormatter.assert_called_once_with(
         logging_mock.Formatter.return_value)
+
+
+def test_lazy(mocker):
+    func = mocker.Mock(return_value='ohai')
+    msg = ulogger.lazy(func)
+
+    func.assert_not_called()
+    assert 'ohai' == str(msg)
+    assert 'ohai' == str(msg)
+    func.assert_called_once_with()
+
+
+def test_lazy_not_called_when_filtered(mocker):
+    func = mocker.Mock(return_value='ohai')
+    logger = logging.getLogger('ulogger.tests.lazy')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.StreamHandler(io.StringIO())
+    logger.addHandler(handler)
+
+    try:
+        logger.debug(ulogger.lazy(func))
+        func.assert_not_called()
+
+        logger.info(ulogger.lazy(func))
+        func.assert_called_once_with()
+        assert 'ohai\n' == handler.stream.getvalue()
+    finally:
+        logger.removeHandler(handler)
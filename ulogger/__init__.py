@@ -16,7 +16,7 @@
 
 from __future__ import absolute_import
 
-from ulogger.ulogger import setup_logging
+from ulogger.ulogger import lazy, setup_logging
 
 __author__ = 'Lynn Root'
 __version__ = '3.0.0'
@@ -25,4 +25,4 @@ __email__ = 'lynn@spotify.com'
 __description__ = 'Micro logging library'
 __uri__ = 'https://github.com/spotify/ulogger'
 
-__all__ = ['setup_logging']
+__all__ = ['lazy', 'setup_logging']
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import os
+import time
+
+
+def default_fmt(label):
+    """Build ulogger's default log format around `label`.
+
+    Args:
+        label (str): Text between the timestamp's milliseconds and the
+            PID, e.g. `'Z <progname>'` or `' <host> <progname>'`.
+    Returns:
+        (str): `%`-style format string.
+    """
+    return '%(asctime)s.%(msecs)03d' + label + ' (%(process)d): %(message)s'
+
+
+class DefaultFormatter(logging.Formatter):
+    """Formatter specialized for the default log format.
+
+    Produces the same output as `logging.Formatter(default_fmt(label))`,
+    but renders each record with a single `str.format` call on
+    precomputed parts instead of `%`-interpolating the record's
+    `__dict__`. The PID is formatted once per process and the date once
+    per second, rather than both once per record.
+
+    Args:
+        label (str): See `default_fmt`.
+        datefmt (:obj:`str`, optional): Date format for `%(asctime)s`.
+    """
+
+    def __init__(self, label, datefmt=None):
+        super().__init__(fmt=default_fmt(label), datefmt=datefmt)
+        self._label = label.replace('{', '{{').replace('}', '}}')
+        self._pid_template = self._make_template(os.getpid())
+        self._last_asctime = (None, None, None)
+
+    def _make_template(self, pid):
+        return pid, '{}.{:03d}' + self._label + ' (' + str(pid) + '): {}'
+
+    def formatTime(self, record, datefmt=None):
+        if not datefmt:
+            return super().formatTime(record, datefmt)
+        # Dates are formatted with second resolution, so only call
+        # strftime when the second (or the date format) changes
+        second = int(record.created)
+        last_second, last_datefmt, asctime = self._last_asctime
+        if second != last_second or datefmt != last_datefmt:
+            asctime = time.strftime(datefmt, self.converter(second))
+            self._last_asctime = (second, datefmt, asctime)
+        return asctime
+
+    def formatMessage(self, record):
+        pid, template = self._pid_template
+        if record.process != pid:
+            # The PID is baked into the template and only changes in a
+            # forked child, so rebuild it just then
+            pid, template = self._pid_template = self._make_template(
+                record.process)
+        return template.format(
+            record.asctime, int(record.msecs), record.message)
@@ -17,14 +17,93 @@
 
 from __future__ import absolute_import
 
+import functools
 import logging
+import os
+import threading
 
 import requests
-from google.cloud import logging_v2 as gcl_logging
-from google.cloud.logging_v2 import handlers as gcl_handlers
-from google.cloud.logging_v2 import resource as gcl_resource
+from urllib3.util import retry
 
 from ulogger import exceptions
+from ulogger import formatters
+
+
+# Instance metadata does not change while the host is running, so it is
+# fetched once per process and shared by all builders.
+_METADATA_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+# Reuse one keep-alive connection to the metadata server across requests,
+# and retry briefly on connection errors and server-side blips
+_SESSION = requests.Session()
+_SESSION.mount('http://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=4,
+    max_retries=retry.Retry(
+        total=2, backoff_factor=0.1, status_forcelist=(500, 502, 503, 504))))
+
+# Logger of the handler's background thread, whose level is set by
+# `debug_thread_worker`
+_BTHREAD_LOGGER = logging.getLogger(
+    'google.cloud.logging_v2.handlers.transports.background_thread')
+
+# Metadata needed to configure the handler, as `(data_type, key)`, mapped
+# to its location in the recursive metadata tree.
+_HOST_METADATA = {
+    ('project', 'project-id'): ('project', 'projectId'),
+    ('instance', 'name'): ('instance', 'name'),
+    ('instance', 'id'): ('instance', 'id'),
+    ('instance', 'zone'): ('instance', 'zone'),
+}
+
+# Environment variables to fall back on, in order of preference, when the
+# metadata server cannot be reached.
+_HOST_METADATA_ENV = {
+    ('project', 'project-id'): ('GOOGLE_CLOUD_PROJECT', 'GCP_PROJECT'),
+    ('instance', 'name'): ('HOSTNAME',),
+    ('instance', 'id'): ('GCE_INSTANCE_ID',),
+    ('instance', 'zone'): ('GCE_ZONE',),
+}
+
+
+def _import_gcl():
+    """Import google-cloud-logging.
+
+    It's slow to import, so it's only imported once a handler is built.
+
+    Returns:
+        (module): `google.cloud.logging_v2`, with its `handlers`,
+            `handlers.transports` and `resource` modules loaded
+    Raises:
+        ULoggerError: when the `stackdriver` extra is not installed
+    """
+    try:
+        import google.cloud.logging_v2.handlers.transports
+        import google.cloud.logging_v2.resource
+    except ImportError as e:
+        raise exceptions.ULoggerError(
+            'The stackdriver handler requires google-cloud-logging; install '
+            'it with `pip install "ulogger[stackdriver]"`. Error: {}'.format(
+                e))
+    return google.cloud.logging_v2
+
+
+@functools.lru_cache(maxsize=8)
+def _get_gcl_client(project_id, credentials):
+    """Get a GCL client, shared by handlers logging to the same project
+    with the same credentials.
+
+    Creating a client discovers credentials and sets up its connection,
+    so it's only done once per `(project_id, credentials)`.
+
+    Args:
+        project_id (str): Project under which logs will be saved in GCL.
+        credentials (obj): An instance of `google.auth.credentials.
+            Credentials`, or `None` to infer from environment.
+    Returns:
+        (obj): Instance of `google.cloud.logging_v2.Client`
+    """
+    return _import_gcl().Client(project=project_id, credentials=credentials)
 
 
 class CloudLoggingHandlerBuilder:
@@ -32,8 +111,9 @@ class CloudLoggingHandlerBuilder:
     `google.cloud.logging_v2.handlers.CloudLoggingHandler`
 
     Instances of the handler will be configured by retrieving the host's
-    metadata. It can send logs to a different GCP project than the host
-    is in by providing 'project_id'.
+    metadata, which is fetched the first time it is needed. It can send
+    logs to a different GCP project than the host is in by providing
+    'project_id'.
 
     Example usage:
 
@@ -47,52 +127,113 @@ class CloudLoggingHandlerBuilder:
 
     Args:
         progname (str): Name of program.
-        fmt (:obj:`str`, optional): Desired log format if different than
-            the default; uses the same formatting string options
-            supported in the stdlib's `logging` module.
+        fmt (:obj:`str`, optional): Desired log format; uses the same
+            formatting string options supported in the stdlib's
+            `logging` module. If neither `fmt` nor `datefmt` is given,
+            the handler sends the bare message.
         datefmt (:obj:`str`, optional): Desired date format if different
             than the default; uses the same formatting string options
             supported in the stdlib's `logging` module.
         project_id (:obj:`str`, optional): Project under which logs will
             be saved in GCL. If not provided, will get it from host's
             metadata.
+        hostname (:obj:`str`, optional): Name of the host instance. If
+            not provided, will get it from host's metadata.
+        instance_id (:obj:`str`, optional): ID of the host instance. If
+            not provided, will get it from host's metadata.
+        zone (:obj:`str`, optional): Zone of the host instance, e.g.
+            `us-central1-f`. If not provided, will get it from host's
+            metadata. If `project_id`, `hostname`, `instance_id` and
+            `zone` are all provided, metadata is never fetched.
         credentials (:obj:`obj`, optional): An instance of `google.auth.
             credentials.Credentials`. If not provided, will infer from
             environment.
         debug_thread_worker (:obj:`bool`, optional): Whether the
             background logging thread should emit DEBUG messages. If
             `False`, thread logger level is set to INFO.
+        batch_size (:obj:`int`, optional): Maximum number of log entries
+            the background thread sends to GCL in one request. If not
+            provided, uses the transport's default.
+        max_latency (:obj:`float`, optional): Seconds the background
+            thread waits for more entries to fill a batch before sending
+            it. If not provided, uses the transport's default.
     """
-    METADATA_ENDPOINT = ('http://metadata.google.internal/computeMetadata/v1/'
-                         '{data_type}/{key}')
+    METADATA_URL = 'http://metadata.google.internal/computeMetadata/v1/'
+    METADATA_TREE_ENDPOINT = METADATA_URL + '?recursive=true&alt=json'
 
     def __init__(self,
                  progname,
                  fmt=None,
                  datefmt=None,
                  project_id=None,
+                 hostname=None,
+                 instance_id=None,
+                 zone=None,
                  credentials=None,
-                 debug_thread_worker=False):
-        if project_id:
-            self.project_id = project_id
-        else:
-            self.project_id = self._get_metadata(
-                data_type='project', key='project-id')
-
+                 debug_thread_worker=False,
+                 batch_size=None,
+                 max_latency=None):
+        # Metadata is only fetched when first needed, so e.g. getting a
+        # formatter for a custom format never touches the network
+        self._project_id = project_id
+        self._hostname = hostname
+        self._instance_id = instance_id
+        self._zone = zone
+        # Host metadata read from the environment when the metadata server
+        # couldn't be reached; kept per builder so a later builder still
+        # asks the server
+        self._env_metadata = None
+        self._resource = None
+        self._formatter = None
         self.progname = progname
         self.fmt = fmt
         self.datefmt = datefmt
+        # `get_formatter` fills in default formats, so remember whether
+        # the caller asked for formatted messages
+        self._use_formatter = bool(fmt or datefmt)
         self.credentials = credentials
         self.debug_thread_worker = debug_thread_worker
-        self.hostname = self._get_metadata(data_type='instance', key='name')
-        self.instance_id = self._get_metadata(data_type='instance', key='id')
-        zone_str = self._get_metadata(data_type='instance', key='zone')
-        self.zone = zone_str.split('/')[-1]
-        self.resource = self._create_gcl_resource()
-
-    def _get_metadata(self, data_type, key, timeout=5):
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+
+    @property
+    def project_id(self):
+        if self._project_id is None:
+            self._project_id = self._get_host_metadata()[
+                'project', 'project-id']
+        return self._project_id
+
+    @property
+    def hostname(self):
+        if self._hostname is None:
+            self._hostname = self._get_host_metadata()['instance', 'name']
+        return self._hostname
+
+    @property
+    def instance_id(self):
+        if self._instance_id is None:
+            self._instance_id = self._get_host_metadata()['instance', 'id']
+        return self._instance_id
+
+    @property
+    def zone(self):
+        if self._zone is None:
+            zone_str = self._get_host_metadata()['instance', 'zone']
+            self._zone = zone_str.rsplit('/', 1)[-1]
+        return self._zone
+
+    @property
+    def resource(self):
+        if self._resource is None:
+            self._resource = self._create_gcl_resource()
+        return self._resource
+
+    def _get_metadata(self, data_type, key, timeout=1):
         """Get host instance metadata (only works on GCP hosts).
 
+        Values are cached for the life of the process; failed lookups
+        are not.
+
         More details about instance metadata:
         https://cloud.google.com/compute/docs/storing-retrieving-metadata
 
@@ -101,16 +242,20 @@ class CloudLoggingHandlerBuilder:
                 instance
             key (str): Key of metadata to fetch
             timeout (int, optional): HTTP request timeout in seconds.
-                Default is 5 seconds.
+                Default is 1 second.
         Returns:
             (str): Plain text value of metadata entry
         Raises:
             GoogleCloudError: when request to metadata endpoint fails
         """
-        endpoint_url = self.METADATA_ENDPOINT.format(
-            data_type=data_type, key=key)
+        with _CACHE_LOCK:
+            metadata_value = _METADATA_CACHE.get((data_type, key))
+        if metadata_value is not None:
+            return metadata_value
+
+        endpoint_url = f'{self.METADATA_URL}{data_type}/{key}'
         try:
-            rsp = requests.get(
+            rsp = _SESSION.get(
                 endpoint_url,
                 headers={'Metadata-Flavor': 'Google'},
                 timeout=timeout)
@@ -125,8 +270,123 @@ class CloudLoggingHandlerBuilder:
             raise exceptions.GoogleCloudError(
                 'Error when fetching metadata from "{url}": server returned '
                 'an empty value.'.format(url=endpoint_url))
+        with _CACHE_LOCK:
+            _METADATA_CACHE[(data_type, key)] = metadata_value
         return metadata_value
 
+    def _get_all_metadata(self, timeout=1):
+        """Get the whole host metadata tree with a single request.
+
+        Args:
+            timeout (int, optional): HTTP request timeout in seconds.
+                Default is 1 second.
+        Returns:
+            (dict): Decoded JSON metadata tree
+        Raises:
+            GoogleCloudError: when request to metadata endpoint fails
+        """
+        endpoint_url = self.METADATA_TREE_ENDPOINT
+        try:
+            rsp = _SESSION.get(
+                endpoint_url,
+                headers={'Metadata-Flavor': 'Google'},
+                timeout=timeout)
+            rsp.raise_for_status()
+            return rsp.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise exceptions.GoogleCloudError(
+                'Could not fetch metadata using "{url}". Error: {e}'.format(
+                    url=endpoint_url, e=e))
+
+    def _get_host_metadata(self, timeout=1):
+        """Get the project and instance metadata to configure the handler.
+
+        Fetched from the recursive metadata tree in one request rather
+        than one request per entry, and cached like `_get_metadata`. If
+        the metadata server can't be reached, falls back to environment
+        variables (see `_get_host_metadata_from_env`). Those values are
+        only reused by this builder, not cached for the process.
+
+        Args:
+            timeout (int, optional): HTTP request timeout in seconds.
+                Default is 1 second.
+        Returns:
+            (dict): Plain text metadata values by `(data_type, key)`
+        Raises:
+            GoogleCloudError: when request to metadata endpoint fails and
+                the environment doesn't provide the metadata the builder
+                wasn't given, or an entry is missing or empty
+        """
+        with _CACHE_LOCK:
+            if all(k in _METADATA_CACHE for k in _HOST_METADATA):
+                return {k: _METADATA_CACHE[k] for k in _HOST_METADATA}
+        if self._env_metadata is not None:
+            return self._env_metadata
+
+        try:
+            tree = self._get_all_metadata(timeout=timeout)
+        except exceptions.GoogleCloudError:
+            metadata = self._get_host_metadata_from_env()
+            given = {
+                ('project', 'project-id'): self._project_id,
+                ('instance', 'name'): self._hostname,
+                ('instance', 'id'): self._instance_id,
+                ('instance', 'zone'): self._zone,
+            }
+            if any(v is None and k not in metadata for k, v in given.items()):
+                raise
+            self._env_metadata = metadata
+            return metadata
+
+        metadata = self._parse_host_metadata(tree)
+        with _CACHE_LOCK:
+            _METADATA_CACHE.update(metadata)
+        return metadata
+
+    def _get_host_metadata_from_env(self):
+        """Get the handler's host metadata from environment variables.
+
+        Used when the metadata server can't be reached, e.g. because of
+        restricted egress. Project ID is read from `GOOGLE_CLOUD_PROJECT`
+        or `GCP_PROJECT`, instance name from `HOSTNAME`, instance ID from
+        `GCE_INSTANCE_ID` and zone from `GCE_ZONE`.
+
+        Returns:
+            (dict): Metadata values by `(data_type, key)`, for those whose
+                environment variables are set
+        """
+        metadata = {}
+        for entry, env_vars in _HOST_METADATA_ENV.items():
+            for env_var in env_vars:
+                if os.environ.get(env_var):
+                    metadata[entry] = os.environ[env_var]
+                    break
+        return metadata
+
+    def _parse_host_metadata(self, tree):
+        """Pick the handler's host metadata out of the metadata tree.
+
+        Args:
+            tree (dict): Decoded recursive metadata tree
+        Returns:
+            (dict): Plain text metadata values by `(data_type, key)`
+        Raises:
+            GoogleCloudError: when an entry is missing or empty
+        """
+        metadata = {}
+        for (data_type, key), path in _HOST_METADATA.items():
+            try:
+                value = str(tree[path[0]][path[1]])
+            except (KeyError, TypeError):
+                value = ''
+            if value.strip() == '':
+                raise exceptions.GoogleCloudError(
+                    'Error when fetching "{key}" from "{type}" metadata: '
+                    'server returned an empty value.'.format(
+                        key=key, type=data_type))
+            metadata[data_type, key] = value
+        return metadata
+
     def _create_gcl_resource(self):
         """Create a configured Resource object.
 
@@ -137,8 +397,7 @@ class CloudLoggingHandlerBuilder:
         Returns:
             (obj): Instance of `google.cloud.logging_v2.resource.Resource`
         """
-
-        return gcl_resource.Resource('gce_instance', {
+        return _import_gcl().resource.Resource('gce_instance', {
             'project_id': self.project_id,
             'instance_id': self.instance_id,
             'zone': self.zone
@@ -153,50 +412,86 @@ class CloudLoggingHandlerBuilder:
         Returns:
             (obj): Instance of `logging.Formatter`
         """
-        if not self.fmt:
-            self.fmt = ('%(asctime)s.%(msecs)03d {host} {progname} '
-                        '(%(process)d): %(message)s').format(
-                        host=self.hostname, progname=self.progname)
+        if self._formatter is not None:
+            return self._formatter
+
         if not self.datefmt:
             self.datefmt = '%Y-%m-%dT%H:%M:%S'
-        return logging.Formatter(fmt=self.fmt, datefmt=self.datefmt)
+        if self.fmt:
+            self._formatter = logging.Formatter(
+                fmt=self.fmt, datefmt=self.datefmt)
+        else:
+            label = ' {host} {progname}'.format(
+                host=self.hostname, progname=self.progname)
+            self.fmt = formatters.default_fmt(label)
+            self._formatter = formatters.DefaultFormatter(
+                label, datefmt=self.datefmt)
+        return self._formatter
 
     def _set_worker_thread_level(self):
         """Sets logging level of the background logging thread to DEBUG or INFO
         """
-        bthread_logger = logging.getLogger(
-            'google.cloud.logging_v2.handlers.transports.background_thread')
         if self.debug_thread_worker:
-            bthread_logger.setLevel(logging.DEBUG)
+            _BTHREAD_LOGGER.setLevel(logging.DEBUG)
         else:
-            bthread_logger.setLevel(logging.INFO)
+            _BTHREAD_LOGGER.setLevel(logging.INFO)
+
+    def _get_transport(self):
+        """Get the transport class for the handler, configured with the
+        requested batching.
+
+        Returns:
+            (obj): `google.cloud.logging_v2.handlers.transports.
+                    BackgroundThreadTransport` or a partial of it
+        """
+        transports = _import_gcl().handlers.transports
+
+        transport_kwargs = {}
+        if self.batch_size is not None:
+            transport_kwargs['batch_size'] = self.batch_size
+        if self.max_latency is not None:
+            transport_kwargs['max_latency'] = self.max_latency
+        if not transport_kwargs:
+            return transports.BackgroundThreadTransport
+        return functools.partial(
+            transports.BackgroundThreadTransport, **transport_kwargs)
 
     def get_handler(self):
         """Create a fully configured CloudLoggingHandler.
 
+        Host, program and PID are sent as structured labels. Unless
+        `fmt` or `datefmt` was given, no formatter is set and the log
+        entry's payload is the bare message, saving the cost of
+        formatting every record.
+
         Returns:
             (obj): Instance of `google.cloud.logging_v2.handlers.
                                 CloudLoggingHandler`
         """
-
-        gcl_client = gcl_logging.Client(
-            project=self.project_id, credentials=self.credentials)
+        gcl_handlers = _import_gcl().handlers
+        gcl_client = _get_gcl_client(self.project_id, self.credentials)
         handler = gcl_handlers.CloudLoggingHandler(
             gcl_client,
+            transport=self._get_transport(),
             resource=self.resource,
             labels={
                 'resource_id': self.instance_id,
                 'resource_project': self.project_id,
                 'resource_zone': self.zone,
-                'resource_host': self.hostname
+                'resource_host': self.hostname,
+                'progname': self.progname,
+                'pid': str(os.getpid()),
             })
-        handler.setFormatter(self.get_formatter())
+        if self._use_formatter:
+            handler.setFormatter(self.get_formatter())
         self._set_worker_thread_level()
         return handler
 
 
 def get_handler(progname, fmt=None, datefmt=None, project_id=None,
-                credentials=None, debug_thread_worker=False, **_):
+                hostname=None, instance_id=None, zone=None, credentials=None,
+                debug_thread_worker=False, batch_size=None, max_latency=None,
+                **_):
     """Helper function to create a Stackdriver handler.
 
     See `ulogger.stackdriver.CloudLoggingHandlerBuilder` for arguments
@@ -208,5 +503,7 @@ def get_handler(progname, fmt=None, datefmt=None, project_id=None,
     """
     builder = CloudLoggingHandlerBuilder(
         progname, fmt=fmt, datefmt=datefmt, project_id=project_id,
-        credentials=credentials, debug_thread_worker=debug_thread_worker)
+        hostname=hostname, instance_id=instance_id, zone=zone,
+        credentials=credentials, debug_thread_worker=debug_thread_worker,
+        batch_size=batch_size, max_latency=max_latency)
     return builder.get_handler()
@@ -18,8 +18,37 @@
 import logging
 import logging.handlers
 import os
+import socket
 import sys
 
+from ulogger import exceptions
+from ulogger import formatters
+
+
+# Local syslog socket per platform environment
+_PLATFORM_ADDRESSES = {
+    'default': '/dev/log',
+    'darwin': '/var/run/syslog',
+}
+
+# Socket types by the `proto` values accepted by the builder
+_SOCKTYPES = {
+    1: socket.SOCK_STREAM,
+    2: socket.SOCK_DGRAM,
+}
+
+
+def _detect_default_env():
+    if (sys.platform.startswith('darwin') and
+            os.path.exists(_PLATFORM_ADDRESSES['darwin'])):
+        return 'darwin'
+    return 'default'
+
+
+# The platform and its syslog socket do not change while running, so
+# only look them up once
+_DEFAULT_ENV = _detect_default_env()
+
 
 class SyslogHandlerBuilder:
     """Creates a Syslog handler based on current environment.
@@ -44,7 +73,7 @@ class SyslogHandlerBuilder:
         proto (:obj:`int`, optional): Protocol for the address if
             `(host, port)` is given. Options: `1` for TCP
             (`socket.SOCK_STREAM`), or `2` for UDP (`socket.SOCK_DGRAM`).
-            Defaults to `2`.
+            Defaults to `2`. Raises `ULoggerError` for other values.
         facility (:obj:`int`, optional): desired facility with which to
             log. Can be either an `int` or a constant from
             `logging.handlers.SysLogHandler`. Default is `16` (local0).
@@ -61,25 +90,44 @@ class SyslogHandlerBuilder:
     def __init__(self, progname, address=None, proto=None, facility=None,
                  fmt=None, datefmt=None):
         self.progname = progname
+        self.proto = self._get_socktype(proto)
         self._environ = self._get_environ()
-        self.fmt = fmt
+        self._label = None
+        if self._environ == 'darwin':
+            # MMM DD HH:MM:SS <host> <progname> (<PID>): <msg>
+            # ex: Aug 25 13:00:51 foo.example.com bar (16911): hello
+            self._default_fmt = self.progname + ' (%(process)d): %(message)s'
+        else:
+            # e.g. 2017-08-25T14:47:44.968+00:00 <host> <progname>[<PID>]: <msg>
+            self._label = 'Z ' + self.progname
+            self._default_fmt = formatters.default_fmt(self._label)
+            datefmt = datefmt or '%Y-%m-%dT%H:%M:%S'
+        self.fmt = fmt or self._default_fmt
         self.datefmt = datefmt
+        self._formatter = None
         self.facility = facility or self.FACILITY
         self.address = self._get_address(address)
-        self.proto = proto or 2  # 2 = socket.SOCK_DGRAM
+
+    def _get_socktype(self, proto):
+        try:
+            return _SOCKTYPES[proto or 2]
+        except KeyError:
+            raise exceptions.ULoggerError(
+                'Unsupported syslog protocol: "{}". Use 1 (TCP) or '
+                '2 (UDP).'.format(proto))
 
     def _get_environ(self):
         syslog_host = os.environ.get('SYSLOG_HOST', None)
         if syslog_host:
             return 'remote'
-        if (sys.platform.startswith('darwin') and
-                os.path.exists('/var/run/syslog')):
-            return 'darwin'
-        return 'default'
+        return _DEFAULT_ENV
 
     def _get_address(self, address):
         if address:
-            if not isinstance(address, str):
+            if isinstance(address, bytes):
+                # SysLogHandler only treats `str` addresses as socket paths
+                address = os.fsdecode(address)
+            elif not isinstance(address, str):
                 if len(address) == 2:
                     if address[1] is None:
                         address = (address[0], logging.handlers.SYSLOG_UDP_PORT)
@@ -87,42 +135,30 @@ class SyslogHandlerBuilder:
                         address = (address[0], int(address[1]))
             return address
 
-        address = {
-            'default': '/dev/log',
-            'darwin': '/var/run/syslog',
-            'remote': (os.environ.get('SYSLOG_HOST'),
-                       os.environ.get('SYSLOG_PORT',
-                                      logging.handlers.SYSLOG_UDP_PORT))
-        }[self._environ]
         if self._environ == 'remote':
-            return (address[0], int(address[1]))
-        return address
+            port = os.environ.get(
+                'SYSLOG_PORT', logging.handlers.SYSLOG_UDP_PORT)
+            return (os.environ.get('SYSLOG_HOST'), int(port))
+        return _PLATFORM_ADDRESSES[self._environ]
 
     def _get_osx_formatter(self):
-        if not self.fmt:
-            # MMM DD HH:MM:SS <host> <progname> (<PID>): <msg>
-            # ex: Aug 25 13:00:51 foo.example.com bar (16911): hello
-            self.fmt = self.progname + ' (%(process)d): %(message)s'
         return logging.Formatter(fmt=self.fmt)
 
     def _get_default_formatter(self):
-        if not self.fmt:
-            # e.g. 2017-08-25T14:47:44.968+00:00 <host> <progname>[<PID>]: <msg>
-            prefix = '%(asctime)s.%(msecs)03dZ '
-            suffix = ' (%(process)d): %(message)s'
-
-            self.fmt = prefix + self.progname + suffix
-
-        if not self.datefmt:
-            self.datefmt = '%Y-%m-%dT%H:%M:%S'
+        if self.fmt == self._default_fmt:
+            return formatters.DefaultFormatter(
+                self._label, datefmt=self.datefmt)
         return logging.Formatter(fmt=self.fmt, datefmt=self.datefmt)
 
     def get_formatter(self):
+        if self._formatter is not None:
+            return self._formatter
+
         if self._environ == 'darwin':
-            formatter = self._get_osx_formatter()
+            self._formatter = self._get_osx_formatter()
         else:
-            formatter = self._get_default_formatter()
-        return formatter
+            self._formatter = self._get_default_formatter()
+        return self._formatter
 
     def get_handler(self):
         handler = logging.handlers.SysLogHandler(
@@ -23,6 +23,34 @@ from importlib import import_module
 from ulogger import exceptions
 
 
+# Handler name -> its module's `get_handler` function, filled in on first
+# use so that later `setup_logging` calls are a dict lookup
+_HANDLER_REGISTRY = {}
+
+
+def _get_handler_function(name):
+    try:
+        return _HANDLER_REGISTRY[name]
+    except KeyError:
+        pass
+
+    try:
+        handler_module = import_module(
+            'ulogger.{}'.format(name), package='ulogger')
+    except ImportError:
+        msg = 'Unsupported log handler: "{}".'.format(name)
+        raise exceptions.ULoggerError(msg)
+
+    try:
+        get_handler = getattr(handler_module, 'get_handler')
+    except AttributeError:
+        msg = '"get_handler" function not implemented for "{}".'
+        raise exceptions.ULoggerError(msg.format(name))
+
+    _HANDLER_REGISTRY[name] = get_handler
+    return get_handler
+
+
 def _setup_default_handler(progname, fmt=None, datefmt=None, **_):
     """Create a Stream handler (default handler).
 
@@ -53,6 +81,46 @@ def _setup_default_handler(progname, fmt=None, datefmt=None, **_):
     return handler
 
 
+class _LazyMessage:
+    """Log message whose text is only built when a handler formats it."""
+
+    __slots__ = ('_func', '_msg')
+
+    def __init__(self, func):
+        self._func = func
+        self._msg = None
+
+    def __str__(self):
+        # Every handler formatting the record asks for the message, so
+        # only call the (expensive) function once
+        if self._msg is None:
+            self._msg = str(self._func())
+        return self._msg
+
+
+def lazy(func):
+    """Defer building an expensive log message until it's emitted.
+
+    Records below the logger's level are dropped before their message
+    is formatted, so `func` is never called for them.
+
+    Example usage:
+
+        import logging
+        from ulogger import lazy
+
+        logging.debug(lazy(lambda: json.dumps(big_payload)))
+
+    Args:
+        func (callable): Function without arguments returning the
+            message.
+
+    Returns:
+        (obj): Message object to pass to the `logging` functions.
+    """
+    return _LazyMessage(func)
+
+
 def setup_logging(progname, level, handlers, **kwargs):
     """Setup logging to stdout (stream), syslog, or stackdriver.
 
@@ -76,26 +144,21 @@ def setup_logging(progname, level, handlers, **kwargs):
             handler documentation for more information on available
             kwargs.
     """
+    new_handlers = []
     for h in handlers:
         if h == 'stream':
             handler = _setup_default_handler(progname, **kwargs)
         else:
-            handler_module_path = 'ulogger.{}'.format(h)
-            try:
-                handler_module = import_module(
-                    handler_module_path, package='ulogger')
-            except ImportError:
-                msg = 'Unsupported log handler: "{}".'.format(h)
-                raise exceptions.ULoggerError(msg)
-
-            try:
-                get_handler = getattr(handler_module, 'get_handler')
-            except AttributeError:
-                msg = '"get_handler" function not implemented for "{}".'
-                raise exceptions.ULoggerError(msg.format(h))
-
+            get_handler = _get_handler_function(h)
             handler = get_handler(progname, **kwargs)
-        logging.getLogger('').addHandler(handler)
+        new_handlers.append(handler)
 
     level = logging.getLevelName(level)
-    logging.getLogger('').setLevel(level)
+    root = logging.getLogger('')
+    # Attach all handlers and set the level while holding the logging
+    # module lock once, rather than once per `Logger.addHandler` call
+    with logging._lock:
+        for handler in new_handlers:
+            if handler not in root.handlers:
+                root.handlers.append(handler)
+        root.setLevel(level)